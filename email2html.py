@@ -1,49 +1,73 @@
 #!/usr/bin/env python3
 import html
-import email
+import itertools
 import logging
 import os
-import pickle
 import re
 import sqlite3
 import sys
+import tempfile
 import traceback
 from datetime import datetime, timedelta
 from email import policy
 from email.message import EmailMessage
+from email.parser import BytesParser, BytesHeaderParser
+from dataclasses import dataclass, field
 from email.utils import parsedate_to_datetime
-from typing import Iterable, Tuple, List
+from typing import Dict, Iterable, Tuple, List, Optional, Union
 
+_IO_BUFFER_SIZE = 128 * 1024
+_PAGE_BATCH_SIZE = 100
+_ID_DELETE = str.maketrans('', '', '@.:/\\<>')
+_CONTENT_TYPE_RE = re.compile(r'\s*([\w.+-]+)/([\w.+-]+)\s*(?:;\s*(?:[^;]*;\s*)*?charset\s*=\s*"?([\w.:+-]+)"?)?', re.IGNORECASE)
+_PARSER = BytesParser(_class=EmailMessage, policy=policy.default)
+_HEADER_PARSER = BytesHeaderParser(_class=EmailMessage, policy=policy.default)
 
+@dataclass(slots=True, repr=False)
 class EmailPage:
-    def __init__(self,
-                 id: str = None,
-                 date: datetime = None,
-                 sender: str = None,
-                 subject: str = None,
-                 content_type: str = None,
-                 headers: List[Tuple[str, str]] = None,
-                 text: str = None,
-                 ):
-        self.id = id
-        self.date = date
-        self.sender = sender
-        self.subject = subject
-        self.content_type = content_type
-        self.headers: List[Tuple[str, str]] = headers if headers else []
-        self.text = text
+    id: str = None
+    date: datetime = None
+    sender: str = None
+    subject: str = None
+    content_type: str = None
+    headers: List[Tuple[str, str]] = field(default_factory=list)
+    text: str = None
+
+    def __post_init__(self):
+        self.headers = self.headers or []
 
     def __repr__(self):
         return f'EmailPage({self.id}, {self.subject}, from {self.sender})'
 
 
+@dataclass(slots=True)
+class EmailPageLite:  # what the index needs, without body and headers
+    id: str
+    date: datetime
+    subject: str
+    sender_display: str
+
+
 class IPageRegistry:  # interface
     def save_page(self, page: EmailPage):
         raise NotImplementedError()
 
+    def save_pages(self, pages: Iterable[EmailPage]):
+        for page in pages:
+            self.save_page(page)
+
     def get_recent_pages(self) -> Iterable[EmailPage]:
         raise NotImplementedError()
 
+    def get_recent_summaries(self) -> Iterable[EmailPageLite]:
+        raise NotImplementedError()
+
+    def get_bodies(self, page_ids: List[str]) -> Dict[str, Union[str, bytes]]:
+        raise NotImplementedError()
+
+    def get_headers(self, page_ids: List[str]) -> Dict[str, List[Tuple[str, str]]]:
+        raise NotImplementedError()
+
 
 class IPageParser:
     def get_page(self) -> EmailPage:
@@ -51,7 +75,7 @@ class IPageParser:
 
 
 class ISiteBuilder:
-    def build_site(self, pages: Iterable[EmailPage]):
+    def build_site(self, pages: Iterable[EmailPageLite], registry: IPageRegistry):
         raise NotImplementedError()
 
 
@@ -62,13 +86,11 @@ class StdinParser(IPageParser):
 
     def get_page(self) -> EmailPage:
         self.log.debug("Going to read a message from stdin")
-        lines = [l for l in sys.stdin]
-        self.log.debug(f'Got {len(lines)} lines, the first one is {lines[0].strip()}')
-        while not self.is_a_header_line(lines[0]):
-            lines.pop(0)
-            self.log.debug(f"Removed the first line, left with {len(lines)} lines")
-        msg: EmailMessage = email.message_from_string(''.join(lines), _class=EmailMessage, policy=policy.default)
-        self.log.debug(f'Parsed email message from {len(lines)} line with {len(msg.defects)} defects')
+        data = sys.stdin.buffer.read()
+        offset = self.find_headers_start(data)
+        self.log.debug(f'Got {len(data)} bytes, skipped {offset} bytes before the headers')
+        msg: EmailMessage = _PARSER.parsebytes(data[offset:])
+        self.log.debug(f'Parsed email message from {len(data) - offset} bytes with {len(msg.defects)} defects')
         page = EmailPage()
         page.date = parsedate_to_datetime(msg['Date']) if msg['Date'] else datetime.now()
         page.sender = str(msg['From'])
@@ -76,26 +98,47 @@ class StdinParser(IPageParser):
         page.id = msg['Message-ID'].strip('<>')
         page.headers = msg.items()
         body = msg.get_body(("html", "plain"))
-        body_encoding = body.get('Content-Type', 'text/plain; charset=UTF-8')
-        page.text = body.get_content()
-        content_type, charset = self.get_content_type_and_charset(body_encoding)
-        if isinstance(page.text, bytes) and charset != 'binary':
-            page.text = page.text.decode(charset)
+        content_type, charset = self.get_content_type_and_charset(str(body.get('Content-Type', 'text/plain; charset=UTF-8')))
+        raw = body.get_payload(decode=True)
+        if content_type == 'binary':
+            page.text = raw
+        else:
+            try:
+                page.text = raw.decode(charset, errors='replace')
+            except LookupError:
+                self.log.debug(f'Unknown charset {charset}, decoding as utf-8')
+                page.text = raw.decode('utf-8', errors='replace')
         page.content_type = content_type
         return page
 
     @staticmethod
     def get_content_type_and_charset(content_type_header):
-        full_type, charset = content_type_header.split(';', 1) if ';' in content_type_header else ('text/plain', 'charset=utf-8')
-        match = re.match(r'charset="([^"])"', charset, re.IGNORECASE)
-        charset = match.group(1) if match else 'utf-8'
-        type, subtype = full_type.split('/')
-        content_type = subtype if type == 'text' else 'binary'
-        return content_type.lower(), charset.lower()
+        match = _CONTENT_TYPE_RE.match(content_type_header)
+        if not match:
+            return 'binary', 'utf-8'
+        type, subtype, charset = match.groups()
+        content_type = subtype if type.lower() == 'text' else 'binary'
+        return content_type.lower(), charset.lower() if charset else 'utf-8'
+
+    def list_headers_only(self, data: bytes) -> List[Tuple[str, str]]:
+        msg: EmailMessage = _HEADER_PARSER.parsebytes(data[self.find_headers_start(data):])
+        return msg.items()
+
+    def find_headers_start(self, data: bytes) -> int:
+        offset = 0
+        while offset < len(data):
+            end = data.find(b'\n', offset)
+            if end < 0:
+                end = len(data)
+            if self._is_header(data[offset:end]):
+                return offset
+            offset = end + 1
+        return 0
 
-    def is_a_header_line(self, line: str):
-        name, _, value = line.partition(':')
-        return ' ' not in name
+    @staticmethod
+    def _is_header(line: bytes):
+        i = line.find(b':')
+        return i > 0 and b' ' not in line[:i] and b'\t' not in line[:i]
 
 
 class StaticHtmlSiteBuilder(ISiteBuilder):
@@ -112,11 +155,24 @@ a.title { font-size: 120%; text-decoration: none; }
 .date { font-size: 80%; }
         """
 
-    def build_site(self, pages: Iterable[EmailPage]):
+    def build_site(self, pages: Iterable[EmailPageLite], registry: IPageRegistry):
         self.log.debug(f'Creating a static site in "{self._output_directory}"')
         os.makedirs(self._output_directory, exist_ok=True)
-        index_lines = []
-        index_lines.append(f"""
+        index_path = os.path.join(self._output_directory, 'index.html')
+        fd, tmp_path = tempfile.mkstemp(dir=self._output_directory, prefix='index.', suffix='.tmp')
+        try:
+            os.fchmod(fd, 0o644)  # mkstemp creates 0600, the index has to stay readable by the web server
+            with os.fdopen(fd, 'wb', buffering=_IO_BUFFER_SIZE) as f:
+                n = self._write_index(f, pages, registry)
+            os.replace(tmp_path, index_path)
+        except BaseException:
+            if os.path.exists(tmp_path):
+                os.remove(tmp_path)
+            raise
+        self.log.debug(f"Written index file with list of {n} pages")
+
+    def _write_index(self, f, pages: Iterable[EmailPageLite], registry: IPageRegistry) -> int:
+        f.write(f"""
         <!doctype html><html lang="en">
         <head>
           <meta charset="utf-8">
@@ -127,37 +183,55 @@ a.title { font-size: 120%; text-decoration: none; }
         </head>
         <body>
         <ul>
-        """)
-        n = 0
-        for page in pages:
-            filename = self.save_page_to_a_file(page)
-            sender = self.get_sender(page)
-            index_lines.append(f"""
-            <li>
-                <a class="title" href="./{filename}">{html.escape(page.subject)}</a> — <span class="sender">{sender}</span> / <span class="date">{page.date.strftime(self.date_format)}</span>
-            </li>
-            """)
-            n += 1
+        """.encode('utf-8'))
+        _escape = html.escape
+        _fmt = self.date_format
+        _write = f.write
+        _save = self.save_page_to_a_file
+        _item_template = """
+        <li>
+            <a class="title" href="./{filename}">{subject}</a> — <span class="sender">{sender}</span> / <span class="date">{date}</span>
+        </li>
+        """.format
+        _date_cache = {}
+
+        def _format_date(d: datetime) -> str:
+            # keyed by minute, date_format must not show anything finer than minutes
+            key = (d.year, d.month, d.day, d.hour, d.minute)
+            formatted = _date_cache.get(key)
+            if formatted is None:
+                formatted = _date_cache[key] = d.strftime(_fmt)
+            return formatted
 
-        index_lines.append("""
+        n = 0
+        pages = iter(pages)
+        while batch := list(itertools.islice(pages, _PAGE_BATCH_SIZE)):
+            page_ids = [page.id for page in batch]
+            bodies = registry.get_bodies(page_ids)
+            headers = registry.get_headers(page_ids)
+            for page in batch:
+                filename = _save(page.id, bodies.get(page.id), headers.get(page.id, []))
+                _write(_item_template(filename=filename, subject=_escape(page.subject), sender=page.sender_display,
+                                      date=_format_date(page.date)).encode('utf-8'))
+                n += 1
+
+        f.write("""
         </ul>
         </body></html>
-        """)
-        self.log.debug(f"Writing index file with list of {n} pages ")
-        with open(os.path.join(self._output_directory, 'index.html'), 'wb') as f:
-            f.writelines(l.encode('utf-8') for l in index_lines)
-
-    def get_sender(self, page):
-        sender, _, __ = page.sender.partition('<')
-        return html.escape(sender).strip(' ')
-
-    def save_page_to_a_file(self, page):
-        filename = page.id.replace('@', '').replace('.', '') + '.html'
-        with open(os.path.join(self._output_directory, filename), 'w') as f:
-            f.write(page.text)
-            f.write("\n\n<!-- Headers:\n")
-            f.write("\n".join(f'{n}: {v}' for n,v in page.headers))
-            f.write("\n\n-->\n")
+        """.encode('utf-8'))
+        return n
+
+    def save_page_to_a_file(self, page_id: str, text: Optional[Union[str, bytes]], headers: List[Tuple[str, str]]):
+        filename = page_id.translate(_ID_DELETE) + '.html'
+        if text is None:
+            self.log.debug(f'No body found for page {page_id}, saving headers only')
+            text = b''
+        elif isinstance(text, str):
+            text = text.encode('utf-8')
+        headers = "\n".join(f'{n}: {v}' for n,v in headers)
+        payload = b''.join((text, f"\n\n<!-- Headers:\n{headers}\n\n-->\n".encode('utf-8')))
+        with open(os.path.join(self._output_directory, filename), 'wb', buffering=_IO_BUFFER_SIZE) as f:
+            f.write(payload)
         return filename
 
 
@@ -170,51 +244,106 @@ class SQLitePageRegistry(IPageRegistry):
         self.connection = sqlite3.connect(self._path_to_file)
         self.connection.row_factory = sqlite3.Row
         self.connection.executescript("""
+            PRAGMA journal_mode=WAL;
+            PRAGMA synchronous=NORMAL;
+            PRAGMA temp_store=MEMORY;
+            PRAGMA cache_size=-20000;
+            PRAGMA mmap_size=268435456;
             CREATE TABLE IF NOT EXISTS page(
                  id TEXT PRIMARY KEY,
                  message_timestamp INTEGER,
                  sender TEXT,
+                 sender_display TEXT,
                  subject TEXT,
                  content_type TEXT,
-                 headers TEXT,
                  body TEXT
             );
+            CREATE INDEX IF NOT EXISTS idx_page_ts ON page(message_timestamp DESC);
+            CREATE TABLE IF NOT EXISTS header(
+                 page_id TEXT REFERENCES page(id),
+                 position INTEGER,
+                 name TEXT,
+                 value TEXT,
+                 PRIMARY KEY(page_id, position)
+            );
             """)
+        if 'sender_display' not in [column['name'] for column in self.connection.execute("PRAGMA table_info(page)")]:
+            self.log.debug('Adding sender_display column to the page table')
+            with self.connection:
+                self.connection.execute("ALTER TABLE page ADD COLUMN sender_display TEXT")
+                self.connection.executemany("UPDATE page SET sender_display = ? WHERE id = ?",
+                                            [(self.get_sender_display(row['sender']), row['id'])
+                                             for row in self.connection.execute("SELECT id, sender FROM page")])
+
+    @staticmethod
+    def get_sender_display(sender: str) -> str:
+        return html.escape(sender.partition('<')[0].strip())
 
     def save_page(self, page: EmailPage):
-        self.log.debug(f'Saving page {page}')
+        self.save_pages([page])
+
+    def save_pages(self, pages: Iterable[EmailPage]):
+        rows = []
+        header_rows = []
+        for page in pages:
+            rows.append({
+                'id': page.id,
+                'message_timestamp': int(page.date.timestamp()),
+                'sender': page.sender,
+                'sender_display': self.get_sender_display(page.sender),
+                'subject': page.subject,
+                'content_type': page.content_type,
+                'body': page.text})
+            header_rows.extend((page.id, i, str(name), str(value)) for i, (name, value) in enumerate(page.headers))
+        self.log.debug(f'Saving {len(rows)} pages with {len(header_rows)} headers')
         with self.connection:
-            try:
-                self.connection.execute("""
-                INSERT INTO page(id, message_timestamp, sender, subject, content_type, body)
-                VALUES(:id, :message_timestamp, :sender, :subject, :content_type, :headers, :body)
-                """, {
-                    'id': page.id,
-                    'message_timestamp': int(page.date.timestamp()),
-                    'sender': page.sender,
-                    'subject': page.subject,
-                    'content_type': page.content_type,
-                    'headers': pickle.dumps(page.headers),
-                    'body': page.text}
-                                        )
-            except sqlite3.IntegrityError as e:
-                self.log.debug(f'Failed saving page {page}: {e}')
+            inserted = self.connection.executemany("""
+            INSERT OR IGNORE INTO page(id, message_timestamp, sender, sender_display, subject, content_type, body)
+            VALUES(:id, :message_timestamp, :sender, :sender_display, :subject, :content_type, :body)
+            """, rows).rowcount
+            self.connection.executemany("INSERT OR IGNORE INTO header(page_id, position, name, value) VALUES(?, ?, ?, ?)",
+                                        header_rows)
+        if inserted < len(rows):
+            self.log.debug(f'Skipped {len(rows) - inserted} already saved pages')
+
+    def get_headers(self, page_ids: List[str]) -> Dict[str, List[Tuple[str, str]]]:
+        headers = {}
+        for row in self.connection.execute(f"""
+                SELECT page_id, name, value FROM header WHERE page_id IN ({', '.join('?' * len(page_ids))})
+                ORDER BY page_id, position""", page_ids):
+            headers.setdefault(row['page_id'], []).append((row['name'], row['value']))
+        return headers
 
     def get_recent_pages(self) -> Iterable[EmailPage]:
         last_datetime = (datetime.now() - timedelta(days=self._recent_period_days))
         oldest_ts = int(last_datetime.timestamp())
         self.log.debug(f"Getting all pages since {last_datetime} = {oldest_ts}")
         with self.connection:
-            for row in self.connection.execute("SELECT * FROM page WHERE message_timestamp > ? ORDER BY message_timestamp DESC", (oldest_ts,)):
-                yield EmailPage(
-                    id=row['id'],
-                    date=datetime.fromtimestamp(row['message_timestamp']),
-                    sender=row['sender'],
-                    subject=row['subject'],
-                    content_type=row['content_type'],
-                    headers=pickle.loads(row['headers']),
-                    text=row['body']
-                )
+            cursor = self.connection.execute("SELECT * FROM page WHERE message_timestamp > ? ORDER BY message_timestamp DESC", (oldest_ts,))
+            while rows := cursor.fetchmany(_PAGE_BATCH_SIZE):
+                headers = self.get_headers([row['id'] for row in rows])
+                for row in rows:
+                    yield EmailPage(
+                        id=row['id'],
+                        date=datetime.fromtimestamp(row['message_timestamp']),
+                        sender=row['sender'],
+                        subject=row['subject'],
+                        content_type=row['content_type'],
+                        headers=headers.get(row['id'], []),
+                        text=row['body']
+                    )
+
+    def get_recent_summaries(self) -> Iterable[EmailPageLite]:
+        last_datetime = (datetime.now() - timedelta(days=self._recent_period_days))
+        oldest_ts = int(last_datetime.timestamp())
+        self.log.debug(f"Getting summaries of all pages since {last_datetime} = {oldest_ts}")
+        with self.connection:
+            for row in self.connection.execute("SELECT id, message_timestamp, subject, sender_display FROM page WHERE message_timestamp > ? ORDER BY message_timestamp DESC", (oldest_ts,)):
+                yield EmailPageLite(row['id'], datetime.fromtimestamp(row['message_timestamp']), row['subject'], row['sender_display'])
+
+    def get_bodies(self, page_ids: List[str]) -> Dict[str, Union[str, bytes]]:
+        return {row['id']: row['body'] for row in self.connection.execute(
+            f"SELECT id, body FROM page WHERE id IN ({', '.join('?' * len(page_ids))})", page_ids)}
 
 
 class Application:
@@ -233,8 +362,7 @@ class Application:
         except Exception as e:
             self.logger.error("Unable to save page from stdin: " + str(e))
             traceback.print_exc(file=sys.stderr)
-        pages = list(self.registry.get_recent_pages())
-        self.site_builder.build_site(pages)
+        self.site_builder.build_site(self.registry.get_recent_summaries(), self.registry)
 
     def _create_options(self):
         import argparse
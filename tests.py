@@ -1,11 +1,138 @@
-from unittest import TestCase
+import io
+import os
+import sqlite3
+import tempfile
+from datetime import datetime
+from unittest import TestCase, mock
 
-from email2html import StdinParser
+from email2html import StdinParser, SQLitePageRegistry, EmailPage, StaticHtmlSiteBuilder
 
 
 class TestMe(TestCase):
     def test_charset_detection(self):
         self.assertEqual(('plain', 'utf-8'), StdinParser.get_content_type_and_charset("text/plain; charset=UTF-8"))
+        self.assertEqual(('html', 'iso-8859-1'), StdinParser.get_content_type_and_charset('text/html; charset="ISO-8859-1"'))
+        self.assertEqual(('plain', 'koi8-r'), StdinParser.get_content_type_and_charset('text/plain; format=flowed; charset=KOI8-R'))
+        self.assertEqual(('html', 'utf-8'), StdinParser.get_content_type_and_charset('text/html'))
+        self.assertEqual(('plain', 'utf-8'), StdinParser.get_content_type_and_charset('text/plain; name="x-charset=foo"'))
+        self.assertEqual(('binary', 'utf-8'), StdinParser.get_content_type_and_charset('image/png; name="a.png"'))
+
+    def test_get_page_skips_mbox_envelope(self):
+        with open(os.path.join(os.path.dirname(__file__), 'examples', 'INBOX-50349.eml'), 'rb') as f:
+            stdin = io.TextIOWrapper(io.BytesIO(f.read()))
+        with mock.patch('sys.stdin', stdin):
+            page = StdinParser().get_page()
+        self.assertEqual('Return-path', page.headers[0][0])
+        self.assertEqual('html', page.content_type)
+        self.assertIsInstance(page.text, str)
+
+    def test_list_headers_only(self):
+        with open(os.path.join(os.path.dirname(__file__), 'examples', 'NatureExample.eml'), 'rb') as f:
+            headers = StdinParser().list_headers_only(f.read())
+        self.assertEqual('Return-path', headers[0][0])
+        self.assertIn('Content-Type', [name for name, value in headers])
+
+    def test_save_pages(self):
+        registry = SQLitePageRegistry(':memory:')
+        pages = [EmailPage(id=f'{i}@example.com', date=datetime.now(), sender='Me <me@example.com>',
+                           subject=f'Subject {i}', content_type='html', headers=[('Subject', f'Subject {i}')],
+                           text=f'<p>{i}</p>') for i in range(3)]
+        registry.save_pages(pages)
+        registry.save_page(pages[0])
+        saved = list(registry.get_recent_pages())
+        self.assertEqual(3, len(saved))
+        self.assertEqual([('Subject', 'Subject 0')], next(p for p in saved if p.id == '0@example.com').headers)
+
+    def test_get_recent_pages_loads_headers_in_batches(self):
+        registry = SQLitePageRegistry(':memory:')
+        registry.save_pages(EmailPage(id=f'{i}@example.com', date=datetime.now(), sender='Me <me@example.com>',
+                                      subject=f'Subject {i}', headers=[('Subject', f'Subject {i}'), ('X-N', str(i))])
+                            for i in range(250))
+        pages = list(registry.get_recent_pages())
+        self.assertEqual(250, len(pages))
+        self.assertTrue(all(p.headers == [('Subject', p.subject), ('X-N', p.id.partition('@')[0])] for p in pages))
+
+    def test_sender_display_added_to_existing_database(self):
+        with tempfile.TemporaryDirectory() as directory:
+            path = os.path.join(directory, 'pages.sqlite3')
+            connection = sqlite3.connect(path)
+            connection.execute("""
+                CREATE TABLE page(id TEXT PRIMARY KEY, message_timestamp INTEGER, sender TEXT, subject TEXT,
+                                  content_type TEXT, headers TEXT, body TEXT)""")
+            connection.execute("INSERT INTO page VALUES('1@example.com', ?, 'Me & Co <me@example.com>', 'Old', 'html', NULL, '<p>1</p>')",
+                               (int(datetime.now().timestamp()),))
+            connection.commit()
+            connection.close()
+            registry = SQLitePageRegistry(path)
+            summaries = list(registry.get_recent_summaries())
+            registry.connection.close()
+        self.assertEqual(['Me &amp; Co'], [summary.sender_display for summary in summaries])
+
+    def test_build_site(self):
+        registry = SQLitePageRegistry(':memory:')
+        registry.save_page(EmailPage(id='1@example.com', date=datetime.now().replace(hour=10, minute=30),
+                                     sender='Me & Co <me@example.com>', subject='Hello <world>', content_type='html',
+                                     headers=[('Subject', 'Hello')], text='<p>Hi</p>'))
+        with tempfile.TemporaryDirectory() as directory:
+            StaticHtmlSiteBuilder(directory).build_site(registry.get_recent_summaries(), registry)
+            with open(os.path.join(directory, 'index.html'), encoding='utf-8') as f:
+                index = f.read()
+            with open(os.path.join(directory, '1examplecom.html'), encoding='utf-8') as f:
+                saved = f.read()
+        self.assertIn('href="./1examplecom.html">Hello &lt;world&gt;</a>', index)
+        self.assertIn('<span class="sender">Me &amp; Co</span>', index)
+        self.assertIn('10:30</span>', index)
+        self.assertTrue(saved.startswith('<p>Hi</p>'))
+        self.assertIn('Subject: Hello', saved)
+
+    def test_save_page_without_headers(self):
+        registry = SQLitePageRegistry(':memory:')
+        registry.save_page(EmailPage(id='1@example.com', date=datetime.now(), sender='Me <me@example.com>',
+                                     subject='No headers', headers=None, text='<p>1</p>'))
+        self.assertEqual([], next(iter(registry.get_recent_pages())).headers)
+
+    def test_save_page_without_body(self):
+        with tempfile.TemporaryDirectory() as directory:
+            filename = StaticHtmlSiteBuilder(directory).save_page_to_a_file('1@example.com', None, [('Subject', 'Hello')])
+            with open(os.path.join(directory, filename), encoding='utf-8') as f:
+                self.assertIn('Subject: Hello', f.read())
+
+    def test_failed_build_keeps_previous_index(self):
+        registry = SQLitePageRegistry(':memory:')
+        registry.save_page(EmailPage(id='1@example.com', date=datetime.now(), sender='Me <me@example.com>',
+                                     subject='First', content_type='html', text='<p>1</p>'))
+        with tempfile.TemporaryDirectory() as directory:
+            builder = StaticHtmlSiteBuilder(directory)
+            builder.build_site(registry.get_recent_summaries(), registry)
+            with open(os.path.join(directory, 'index.html'), encoding='utf-8') as f:
+                previous_index = f.read()
+            registry.save_page(EmailPage(id='x' * 300 + '@example.com', date=datetime.now(), sender='Me <me@example.com>',
+                                         subject='Too long', content_type='html', text='<p>2</p>'))
+            with self.assertRaises(OSError):
+                builder.build_site(registry.get_recent_summaries(), registry)
+            with open(os.path.join(directory, 'index.html'), encoding='utf-8') as f:
+                self.assertEqual(previous_index, f.read())
+            self.assertEqual(['1examplecom.html', 'index.html'], sorted(os.listdir(directory)))
+
+    def test_concurrent_builds_do_not_share_index_file(self):
+        registry = SQLitePageRegistry(':memory:')
+        registry.save_page(EmailPage(id='1@example.com', date=datetime.now(), sender='Me <me@example.com>',
+                                     subject='First', content_type='html', text='<p>1</p>'))
+        with tempfile.TemporaryDirectory() as directory:
+            builder = StaticHtmlSiteBuilder(directory)
+
+            def pages_with_a_build_in_between():
+                for page in registry.get_recent_summaries():
+                    yield page
+                    builder.build_site(registry.get_recent_summaries(), registry)
+
+            builder.build_site(pages_with_a_build_in_between(), registry)
+            with open(os.path.join(directory, 'index.html'), encoding='utf-8') as f:
+                index = f.read()
+            self.assertIn('First', index)
+            self.assertIn('</html>', index)
+            self.assertEqual(['1examplecom.html', 'index.html'], sorted(os.listdir(directory)))
+            self.assertEqual(0o644, os.stat(os.path.join(directory, 'index.html')).st_mode & 0o777)
 
 
 class AddNumber:
@@ -36,15 +163,11 @@ class TestNonClosureParametrisation(TestCase):
 from unittest import TestCase
 
 
+_PALINDROME_TRANS = str.maketrans({'é': 'e', 'è': 'e', 'ê': 'e', 'à': 'a', **dict.fromkeys(" !.?,'" + '"')})
+
+
 def isPalindrome(a_string: str):
-    symbol_maps = {'e' : 'éèê', 'a': 'à'}
-    spaces = " !.?,'"+'"'
-    canonised_string = a_string.lower()
-    for s in spaces:
-        canonised_string = canonised_string.replace(s,'')
-    for canonical_symbol, alternative_symbols in symbol_maps.items():
-        for s in alternative_symbols:
-            canonised_string = canonised_string.replace(s, canonical_symbol)
+    canonised_string = a_string.lower().translate(_PALINDROME_TRANS)
     return canonised_string == canonised_string[::-1]
 
 class TestPython(TestCase):